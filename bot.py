@@ -1,7 +1,7 @@
 import logging
 import os
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 )
@@ -12,6 +12,11 @@ import time # For delays if needed
 from database import Database # Our custom database interaction module
 from downloader import Downloader, DOWNLOADS_DIR # Our custom downloader module
 from utils import check_user_force_subscription # Utility for force subscribe feature
+from uploads import ( # Local Bot API server settings and helpers for sending downloaded files
+    LOCAL_BOT_API_URL, USE_LOCAL_BOT_API, SEND_FILE_KWARGS, build_upload_source, cleanup_delay_after_failed_send
+)
+from inflight import InFlightDownloads # Shares one download between identical concurrent requests
+import url_router # Platform detection, URL canonicalisation and short-link resolution
 from telegram.helpers import InputMediaPhoto, InputMediaVideo # For sending media groups (Instagram albums)
 
 # Load environment variables from .env file at the project root
@@ -29,6 +34,11 @@ MAX_FILE_SIZE_FOR_DIRECT_PHOTO_MB = 20  # Roughly 20MB for photos
 MAX_FILE_SIZE_FOR_DIRECT_VIDEO_AUDIO_MB = 50 # Roughly 50MB for video/audio (Telegram compresses it for playback)
 TELEGRAM_DOCUMENT_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024 # 2 GB for sending as document
 
+if USE_LOCAL_BOT_API:
+    # A local server lifts the upload limit to 2000 MB for every send method
+    MAX_FILE_SIZE_FOR_DIRECT_VIDEO_AUDIO_MB = 2000
+    TELEGRAM_DOCUMENT_MAX_SIZE_BYTES = 2000 * 1024 * 1024
+
 
 # --- Webhook Specific Settings ---
 WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443)) # Port for the bot's webhook to listen on
@@ -47,6 +57,7 @@ logger = logging.getLogger(__name__)
 # --- Initialize Database and Downloader Classes ---
 db = Database()
 downloader = Downloader()
+download_jobs = InFlightDownloads(downloader)
 
 # --- Helper Functions for Bot Logic ---
 
@@ -104,6 +115,13 @@ async def check_subscription_and_notify(update: Update, context: ContextTypes.DE
         return False
     return True
 
+def get_sent_file_id(message):
+    """Returns the file_id of the media in a sent message, or None if it has none."""
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)): # Photos come as a list of sizes, the last one is the largest
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, 'file_id', None)
+
 # --- Command Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -245,214 +263,237 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("لطفاً یک لینک معتبر (که با http:// یا https:// شروع شود) ارسال کنید.")
         return
 
+    # Inform user that download is in progress (before resolving short links, which can take a few seconds)
+    processing_msg = await update.message.reply_text("در حال پردازش و دانلود... لطفاً منتظر بمانید. (این فرایند بسته به حجم فایل ممکن است کمی طول بکشد.)")
+
     # --- Platform Determination ---
+    # Expand short links (cached) and match the URL against the known platform routes.
+    # route['url'] is the canonical link (no tracking parameters), route['key'] identifies the content itself.
+    route = await url_router.resolve_url(message_text)
+
     # Try to deduce platform from URL if state is generic or idle (user pasted link directly)
     platform = platform_from_state # Default: use platform selected by button
     if platform == 'generic' or platform is None: # If not specified by button or general downloader button clicked
-        if "tiktok.com" in message_text: platform = "tiktok"
-        elif "instagram.com" in message_text: platform = "instagram"
-        elif "youtube.com" in message_text or "youtu.be" in message_text: platform = "youtube"
-        elif "x.com" in message_text or "twitter.com" in message_text: platform = "x"
-        else: platform = "generic" # Keep as generic if URL doesn't match specific platforms
+        platform = route['platform'] # 'generic' if URL doesn't match specific platforms
 
     # --- Check if the selected/detected platform's button is enabled in settings ---
     if platform_from_state and db.get_setting(f'button_{platform}_enabled') != 'true':
-        await update.message.reply_text(f"متاسفانه، دانلود از {platform.upper()} در حال حاضر غیرفعال است.")
+        await processing_msg.edit_text(f"متاسفانه، دانلود از {platform.upper()} در حال حاضر غیرفعال است.")
         return
     elif not platform_from_state and platform != 'generic' and db.get_setting(f'button_{platform}_enabled') != 'true':
-         await update.message.reply_text(f"سرویس {platform.upper()} در حال حاضر غیرفعال است. لطفاً لینک یک سرویس فعال را ارسال کنید.")
+         await processing_msg.edit_text(f"سرویس {platform.upper()} در حال حاضر غیرفعال است. لطفاً لینک یک سرویس فعال را ارسال کنید.")
          return
     elif platform == 'generic' and db.get_setting(f'button_generic_enabled') != 'true':
-        await update.message.reply_text(f"سرویس دانلود از لینک‌های عمومی در حال حاضر غیرفعال است.")
+        await processing_msg.edit_text(f"سرویس دانلود از لینک‌های عمومی در حال حاضر غیرفعال است.")
         return
          
     # --- Start Download Process ---
-    # Inform user that download is in progress
-    processing_msg = await update.message.reply_text("در حال پردازش و دانلود... لطفاً منتظر بمانید. (این فرایند بسته به حجم فایل ممکن است کمی طول بکشد.)")
-
     # Log download attempt as pending in the database
     db.add_download_log(user_db_id, user.id, platform, message_text, 'pending')
     
     # Run the download operation in a separate thread to not block the event loop
     # 'best_overall' means yt-dlp decides the best quality for both video and audio.
-    result = await downloader.download_content(message_text, 'best_overall')
+    # Identical concurrent requests (same content, even via different links) share one download;
+    # its files are removed once the last of them is done. The canonical URL lets yt-dlp pick the
+    # platform's extractor directly instead of falling back to the generic one.
+    job = download_jobs.join(route['url'], 'best_overall', key=route['key'])
+    cleanup_delay = 0 # Seconds to keep the files after this handler leaves the job
+    try:
+        result = await job.result()
     
-    if result['status'] == 'completed':
-        # Download successful, now send the file to the user
-        file_path = result['path']
-        file_size = result['file_size']
-        file_type = result['file_type'] # 'video', 'audio', 'image'
-        file_title = result['title']
+        if result['status'] == 'completed':
+            # Download successful, now send the file to the user
+            file_path = result['path']
+            file_size = result['file_size']
+            file_type = result['file_type'] # 'video', 'audio', 'image'
+            file_title = result['title']
 
-        # Log completion
-        db.add_download_log(user_db_id, user.id, platform, message_text, 'completed', file_path, file_size)
+            # Log completion
+            db.add_download_log(user_db_id, user.id, platform, message_text, 'completed', file_path, file_size)
 
-        try:
-            # Check against Telegram's general document size limit (2GB)
-            if file_size > TELEGRAM_DOCUMENT_MAX_SIZE_BYTES:
-                await processing_msg.edit_text(
-                    "متاسفانه حجم فایل خیلی زیاد است و امکان ارسال آن از طریق تلگرام وجود ندارد (حداکثر 2GB)."
-                )
-                db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, 'File too large for Telegram (over 2GB).')
-                downloader.cleanup_file(file_path)
-                return
-                 
-            # Open file in binary read mode to send via Telegram API
-            with open(file_path, 'rb') as f:
-                # Decide which Telegram send method to use based on file type and size
-                # Note: For send_video/send_audio/send_photo, Telegram might re-compress
-                # Sending as document is generally safest for larger files or to preserve original quality.
-                if file_type == 'video' and file_size <= MAX_VIDEO_AUDIO_SIZE_MB * 1024 * 1024:
-                    await context.bot.send_video(
-                        chat_id=chat_id,
-                        video=InputFile(f, filename=os.path.basename(file_path)),
-                        caption=file_title,
-                        # thumbnail=InputFile(open(result['thumbnail_path'], 'rb')) if 'thumbnail_path' in result else None # if you handle thumbnail downloads
-                    )
-                elif file_type == 'audio' and file_size <= MAX_VIDEO_AUDIO_SIZE_MB * 1024 * 1024:
-                    await context.bot.send_audio(
-                        chat_id=chat_id, 
-                        audio=InputFile(f, filename=os.path.basename(file_path)), 
-                        caption=file_title
-                    )
-                elif file_type == 'image' and file_size <= MAX_FILE_SIZE_FOR_DIRECT_PHOTO_MB * 1024 * 1024:
-                    await context.bot.send_photo(
-                        chat_id=chat_id, 
-                        photo=InputFile(f, filename=os.path.basename(file_path)), 
-                        caption=file_title
-                    )
-                else:
-                    # For larger files or general file types, send as document
-                    await context.bot.send_document(
-                        chat_id=chat_id, 
-                        document=InputFile(f, filename=os.path.basename(file_path)), 
-                        caption=file_title
+            try:
+                # Check against Telegram's general document size limit (2GB)
+                if file_size > TELEGRAM_DOCUMENT_MAX_SIZE_BYTES:
+                    await processing_msg.edit_text(
+                        "متاسفانه حجم فایل خیلی زیاد است و امکان ارسال آن از طریق تلگرام وجود ندارد (حداکثر 2GB)."
                     )
+                    db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, 'File too large for Telegram (over 2GB).')
+                    return
+                 
+                async def send_file(file_ids):
+                    # A file_id from an earlier waiter, a file:// URI (local Bot API server) or the file contents to upload
+                    upload_source = file_ids.get(file_path) or build_upload_source(file_path)
+
+                    # Decide which Telegram send method to use based on file type and size
+                    # Note: For send_video/send_audio/send_photo, Telegram might re-compress
+                    # Sending as document is generally safest for larger files or to preserve original quality.
+                    if file_type == 'video' and file_size <= MAX_FILE_SIZE_FOR_DIRECT_VIDEO_AUDIO_MB * 1024 * 1024:
+                        sent_message = await context.bot.send_video(
+                            chat_id=chat_id,
+                            video=upload_source,
+                            caption=file_title,
+                            # thumbnail=build_upload_source(result['thumbnail_path']) if 'thumbnail_path' in result else None # if you handle thumbnail downloads
+                            **SEND_FILE_KWARGS
+                        )
+                    elif file_type == 'audio' and file_size <= MAX_FILE_SIZE_FOR_DIRECT_VIDEO_AUDIO_MB * 1024 * 1024:
+                        sent_message = await context.bot.send_audio(
+                            chat_id=chat_id, 
+                            audio=upload_source, 
+                            caption=file_title,
+                            **SEND_FILE_KWARGS
+                        )
+                    elif file_type == 'image' and file_size <= MAX_FILE_SIZE_FOR_DIRECT_PHOTO_MB * 1024 * 1024:
+                        sent_message = await context.bot.send_photo(
+                            chat_id=chat_id, 
+                            photo=upload_source, 
+                            caption=file_title,
+                            **SEND_FILE_KWARGS
+                        )
+                    else:
+                        # For larger files or general file types, send as document
+                        sent_message = await context.bot.send_document(
+                            chat_id=chat_id, 
+                            document=upload_source, 
+                            caption=file_title,
+                            **SEND_FILE_KWARGS
+                        )
+                    return {file_path: get_sent_file_id(sent_message)}
+
+                # Only the first upload of the file waits for send_lock; once a file_id exists
+                # every other waiter resends it straight away
+                await job.send_files([file_path], send_file)
+
+                await processing_msg.delete() # Delete the "processing..." message
+                # The file itself is removed by download_jobs once every waiter has sent it.
+                # Each send call only returns after the Bot API (local or public) has read the whole file.
+                # Log that the file was successfully sent to the user
+                db.add_download_log(user_db_id, user.id, platform, message_text, 'file_sent', file_path, file_size)
 
-            await processing_msg.delete() # Delete the "processing..." message
-            downloader.cleanup_file(file_path) # Delete the downloaded file from server to save space
-            # Log that the file was successfully sent to the user
-            db.add_download_log(user_db_id, user.id, platform, message_text, 'file_sent', file_path, file_size)
-
-        except TelegramError as e:
-            # Handle specific Telegram API errors
-            error_message_to_user = f"خطا در ارسال فایل به تلگرام: {e}"
-            if "file size is too big" in str(e):
-                error_message_to_user = "خطا در ارسال فایل: حجم فایل بیش از حد مجاز تلگرام است."
-                db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, f"Telegram send error: {e}")
-            elif "Request entity too large" in str(e):
-                error_message_to_user = "خطا در ارسال فایل: درخواست ارسال بیش از حد بزرگ است."
-                db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, f"Telegram send error: {e}")
-            elif "bot was blocked by the user" in str(e):
-                error_message_to_user = "خطا در ارسال فایل: ربات توسط شما مسدود شده است."
-                db.set_user_blocked_status(user.id, True) # Mark user as blocked in DB
+            except TelegramError as e:
+                # Handle specific Telegram API errors
+                error_message_to_user = f"خطا در ارسال فایل به تلگرام: {e}"
+                if "file size is too big" in str(e):
+                    error_message_to_user = "خطا در ارسال فایل: حجم فایل بیش از حد مجاز تلگرام است."
+                    db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, f"Telegram send error: {e}")
+                elif "Request entity too large" in str(e):
+                    error_message_to_user = "خطا در ارسال فایل: درخواست ارسال بیش از حد بزرگ است."
+                    db.add_download_log(user_db_id, user.id, platform, message_text, 'too_large', file_path, file_size, f"Telegram send error: {e}")
+                elif "bot was blocked by the user" in str(e):
+                    error_message_to_user = "خطا در ارسال فایل: ربات توسط شما مسدود شده است."
+                    db.set_user_blocked_status(user.id, True) # Mark user as blocked in DB
             
-            await processing_msg.edit_text(error_message_to_user)
-            logger.error(f"Telegram API Error sending file {file_path} to user {user.id}: {e}")
-            downloader.cleanup_file(file_path) # Still cleanup
-            db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', file_path, file_size, f"Telegram API error: {e}")
-
-        except Exception as e:
-            # Catch any other unexpected errors during file sending
-            await processing_msg.edit_text(f"خطا در ارسال فایل: {e}. لطفاً دوباره امتحان کنید.")
-            logger.error(f"Unknown error sending file {file_path} to Telegram for user {user.id}: {e}")
-            downloader.cleanup_file(file_path) # Still cleanup
-            db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', file_path, file_size, f"Unexpected send error: {e}")
-
-    elif result['status'] == 'album':
-        # Handle media albums (e.g., Instagram carousel posts)
-        try:
-            media_group = []
-            # sent_count_album_items = 0
+                await processing_msg.edit_text(error_message_to_user)
+                logger.error(f"Telegram API Error sending file {file_path} to user {user.id}: {e}")
+                cleanup_delay = cleanup_delay_after_failed_send(e)
+                db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', file_path, file_size, f"Telegram API error: {e}")
+
+            except Exception as e:
+                # Catch any other unexpected errors during file sending
+                await processing_msg.edit_text(f"خطا در ارسال فایل: {e}. لطفاً دوباره امتحان کنید.")
+                logger.error(f"Unknown error sending file {file_path} to Telegram for user {user.id}: {e}")
+                db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', file_path, file_size, f"Unexpected send error: {e}")
+
+        elif result['status'] == 'album':
+            # Handle media albums (e.g., Instagram carousel posts)
+            try:
+                # (InputMedia class, path, title) of each item to send as a group; the media itself is
+                # built right before sending so an earlier waiter's file_id can be used instead of the file
+                media_group = []
+                # sent_count_album_items = 0
             
-            # Telegram Media Group limitations: Max 10 photos/videos. File size limits.
-            # If an item is too large for a group, or too many items, they need to be sent individually as documents.
+                # Telegram Media Group limitations: Max 10 photos/videos. File size limits.
+                # If an item is too large for a group, or too many items, they need to be sent individually as documents.
 
-            for item in result['files']:
-                path = item['path']
-                title = item['title']
-                file_type = item['type'] 
+                for item in result['files']:
+                    path = item['path']
+                    title = item['title']
+                    file_type = item['type'] 
                 
-                if not os.path.exists(path):
-                    logger.warning(f"File {path} from album not found, skipping for sending.")
-                    continue
-
-                item_size = os.path.getsize(path)
-
-                # Prioritize adding to media_group if it meets typical media size limits
-                # Otherwise, plan to send it as a separate document
-                if file_type == 'video' and item_size <= MAX_VIDEO_AUDIO_SIZE_MB * 1024 * 1024:
-                    media_group.append(InputMediaVideo(media=InputFile(open(path, 'rb')), caption=title))
-                elif file_type == 'image' and item_size <= MAX_FILE_SIZE_FOR_DIRECT_PHOTO_MB * 1024 * 1024:
-                    media_group.append(InputMediaPhoto(media=InputFile(open(path, 'rb')), caption=title))
-                else:
-                    # Item is too large for media group or other non-standard type, send as document
-                    await context.bot.send_document(
-                        chat_id=chat_id, 
-                        document=InputFile(open(path, 'rb'), filename=os.path.basename(path)), 
-                        caption=title
-                    )
-                    logger.info(f"Sent album item {os.path.basename(path)} as document for user {user.id} due to size/type limitations.")
-                    downloader.cleanup_file(path) # Clean up individual items as they are sent
-                    # sent_count_album_items += 1 # If tracking individually sent items
-
-
-            # Send media group in chunks of 10
-            # Ensure proper handling of file handles when sending media groups (InputFile from open() objects)
-            # The files might be opened multiple times, and need proper closing.
-            # Python-telegram-bot handles open file objects internally quite well,
-            # but for robust code, you might explicitly manage file handles.
+                    if not os.path.exists(path):
+                        logger.warning(f"File {path} from album not found, skipping for sending.")
+                        continue
+
+                    item_size = os.path.getsize(path)
+
+                    # Prioritize adding to media_group if it meets typical media size limits
+                    # Otherwise, plan to send it as a separate document
+                    if file_type == 'video' and item_size <= MAX_FILE_SIZE_FOR_DIRECT_VIDEO_AUDIO_MB * 1024 * 1024:
+                        media_group.append((InputMediaVideo, path, title))
+                    elif file_type == 'image' and item_size <= MAX_FILE_SIZE_FOR_DIRECT_PHOTO_MB * 1024 * 1024:
+                        media_group.append((InputMediaPhoto, path, title))
+                    else:
+                        # Item is too large for media group or other non-standard type, send as document
+                        async def send_album_document(file_ids, path=path, title=title):
+                            sent_message = await context.bot.send_document(
+                                chat_id=chat_id, 
+                                document=file_ids.get(path) or build_upload_source(path), 
+                                caption=title,
+                                **SEND_FILE_KWARGS
+                            )
+                            return {path: get_sent_file_id(sent_message)}
+
+                        await job.send_files([path], send_album_document)
+                        logger.info(f"Sent album item {os.path.basename(path)} as document for user {user.id} due to size/type limitations.")
+                        # sent_count_album_items += 1 # If tracking individually sent items
+
+
+                # Send media group in chunks of 10
             
-            total_media_items_sent_in_groups = 0
-            for i in range(0, len(media_group), 10):
-                try:
-                    current_chunk = media_group[i:i+10]
-                    # This makes actual file handles, which need to stay open until sent
-                    media_for_send = [InputMediaPhoto(media.media) if isinstance(media, InputMediaPhoto) else InputMediaVideo(media.media) for media in current_chunk]
-                    
-                    # Ensure captions are handled. Captions only on first item.
-                    if current_chunk:
-                         media_for_send[0].caption = current_chunk[0].caption
-
-                    await context.bot.send_media_group(chat_id=chat_id, media=media_for_send)
-                    total_media_items_sent_in_groups += len(current_chunk)
-
-                except TelegramError as e:
-                    logger.error(f"Error sending media group chunk to user {user.id}: {e}")
-                    # You might add logic here to retry sending remaining items as documents if media group fails
-                    await context.bot.send_message(chat_id=chat_id, text=f"خطا در ارسال برخی آیتم‌های آلبوم به صورت گروهی. (Error: {e})")
-                except Exception as e:
-                     logger.error(f"Unexpected error sending media group: {e}")
-                     await context.bot.send_message(chat_id=chat_id, text=f"خطا در ارسال آلبوم. (Error: {e})")
-
-            await processing_msg.delete() # Delete "processing..." message
-
-            # Clean up all files *after* all attempts to send the album
-            for item in result['files']:
-                downloader.cleanup_file(item['path'])
+                total_media_items_sent_in_groups = 0
+                for i in range(0, len(media_group), 10):
+                    try:
+                        current_chunk = media_group[i:i+10]
+
+                        async def send_chunk(file_ids, current_chunk=current_chunk):
+                            # Ensure captions are handled. Captions only on first item.
+                            media_for_send = [
+                                media_class(file_ids.get(path) or build_upload_source(path, attach=True), caption=title if index == 0 else None)
+                                for index, (media_class, path, title) in enumerate(current_chunk)
+                            ]
+
+                            sent_messages = await context.bot.send_media_group(chat_id=chat_id, media=media_for_send, **SEND_FILE_KWARGS)
+                            return {path: get_sent_file_id(sent_message) for (_, path, _), sent_message in zip(current_chunk, sent_messages)}
+
+                        await job.send_files([path for _, path, _ in current_chunk], send_chunk)
+                        total_media_items_sent_in_groups += len(current_chunk)
+
+                    except TelegramError as e:
+                        logger.error(f"Error sending media group chunk to user {user.id}: {e}")
+                        # Keep the album files around if a local Bot API server may still be reading them
+                        cleanup_delay = max(cleanup_delay, cleanup_delay_after_failed_send(e))
+                        # You might add logic here to retry sending remaining items as documents if media group fails
+                        await context.bot.send_message(chat_id=chat_id, text=f"خطا در ارسال برخی آیتم‌های آلبوم به صورت گروهی. (Error: {e})")
+                    except Exception as e:
+                         logger.error(f"Unexpected error sending media group: {e}")
+                         await context.bot.send_message(chat_id=chat_id, text=f"خطا در ارسال آلبوم. (Error: {e})")
+
+                await processing_msg.delete() # Delete "processing..." message
+                # Album files are removed by download_jobs after every waiter has tried to send them
             
-            # Log album sending status
-            if total_media_items_sent_in_groups > 0:
-                db.add_download_log(user_db_id, user.id, platform, message_text, 'file_sent', error_message=f'Album sent successfully with {total_media_items_sent_in_groups} media group items.')
-            else:
-                await update.message.reply_text("متاسفانه هیچ کدام از محتوای آلبوم قابل ارسال نبود.")
-                db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message='No album items sent or all sent as documents.')
+                # Log album sending status
+                if total_media_items_sent_in_groups > 0:
+                    db.add_download_log(user_db_id, user.id, platform, message_text, 'file_sent', error_message=f'Album sent successfully with {total_media_items_sent_in_groups} media group items.')
+                else:
+                    await update.message.reply_text("متاسفانه هیچ کدام از محتوای آلبوم قابل ارسال نبود.")
+                    db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message='No album items sent or all sent as documents.')
 
 
-        except Exception as e:
-            await processing_msg.edit_text(f"خطا در ارسال آلبوم: {e}")
-            logger.error(f"Error handling album from {message_text} for user {user.id}: {e}")
-            for item in result['files']: # Ensure cleanup even if album sending fails
-                downloader.cleanup_file(item['path'])
-            db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message=f"Album handling error: {e}")
+            except Exception as e:
+                await processing_msg.edit_text(f"خطا در ارسال آلبوم: {e}")
+                logger.error(f"Error handling album from {message_text} for user {user.id}: {e}")
+                cleanup_delay = max(cleanup_delay, cleanup_delay_after_failed_send(e)) # e.g. a timed out send_document
+                db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message=f"Album handling error: {e}")
 
-    else:
-        # Download failed or returned an unknown status
-        await processing_msg.edit_text(
-            result.get('message', "خطا در دانلود یا محتوا یافت نشد. لطفاً مطمئن شوید لینک معتبر و عمومی است.")
-        )
-        # Log the failure
-        db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message=result.get('message', 'Unknown download error'))
+        else:
+            # Download failed or returned an unknown status
+            await processing_msg.edit_text(
+                result.get('message', "خطا در دانلود یا محتوا یافت نشد. لطفاً مطمئن شوید لینک معتبر و عمومی است.")
+            )
+            # Log the failure
+            db.add_download_log(user_db_id, user.id, platform, message_text, 'failed', error_message=result.get('message', 'Unknown download error'))
+
+    finally:
+        download_jobs.leave(job, cleanup_delay)
 
 
 # --- Main Function to Run the Bot ---
@@ -463,7 +504,17 @@ def main():
         logger.critical("BOT_TOKEN or DOMAIN_NAME environment variables are not set. Exiting.")
         exit(1)
         
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if USE_LOCAL_BOT_API:
+        # Route all Bot API calls through the self-hosted server. local_mode lets the library
+        # treat file paths as local files on the server's disk instead of uploading them.
+        builder = (
+            builder.base_url(f"{LOCAL_BOT_API_URL}/bot")
+                   .base_file_url(f"{LOCAL_BOT_API_URL}/file/bot")
+                   .local_mode(True)
+        )
+        logger.info(f"Using local Bot API server at {LOCAL_BOT_API_URL}; files are sent by path.")
+    application = builder.build()
 
     # --- Register Handlers ---
     application.add_handler(CommandHandler("start", start_command))
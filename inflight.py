@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadJob:
+    """
+    One download shared by every request for the same URL and format.
+    Each handler that joins the job holds a reference to it; the downloaded files
+    are only removed after the last handler has left.
+    """
+    def __init__(self, key, task):
+        self.key = key
+        self.task = task # asyncio.Task running downloader.download_content
+        self.waiters = 0 # Number of handlers currently holding this job
+        # Telegram file_id of every file that has already been uploaded once (file path -> file_id),
+        # so later waiters can resend it without uploading the same bytes again.
+        self.file_ids = {}
+        # Held only while uploading files that have no file_id yet, so a file is uploaded once
+        # and waiters whose files already have a file_id never queue behind an upload
+        self.send_lock = asyncio.Lock()
+        # Monotonic time before which the files must stay on disk (e.g. a local Bot API server
+        # may still be reading them after a timed out send). Every waiter's leave() honours it.
+        self.release_at = 0
+        self.released = False # True once the files have been (or are being) cleaned up
+
+    def remember_file_id(self, path, file_id):
+        """Records the Telegram file_id of an uploaded file, ignoring sends that returned none."""
+        if file_id is not None:
+            self.file_ids.setdefault(path, file_id)
+
+    async def send_files(self, paths, send):
+        """
+        Sends the given files through 'send', an async callable that receives the known
+        file_ids (path -> file_id) and returns the file_ids it got back from Telegram.
+        If every path already has a file_id the send happens straight away; otherwise it runs
+        under send_lock, and file_ids are checked again once the lock is held in case another
+        waiter uploaded them in the meantime.
+        """
+        if not all(path in self.file_ids for path in paths):
+            async with self.send_lock:
+                if not all(path in self.file_ids for path in paths):
+                    for path, file_id in (await send(self.file_ids)).items():
+                        self.remember_file_id(path, file_id)
+                    return
+        await send(self.file_ids)
+
+    async def result(self):
+        """Waits for the shared download and returns its result dict."""
+        # shield() keeps the download running for the other waiters if this handler is cancelled
+        return await asyncio.shield(self.task)
+
+    def file_paths(self):
+        """Returns the paths of all files produced by the finished download."""
+        if not self.task.done() or self.task.cancelled() or self.task.exception():
+            return []
+        result = self.task.result()
+        if result.get('status') == 'completed':
+            return [result['path']]
+        if result.get('status') == 'album':
+            return [item['path'] for item in result['files']]
+        return []
+
+
+class InFlightDownloads:
+    """
+    Coalesces concurrent downloads of the same content.
+    The first request for a key starts the download, later requests attach to the
+    running job and receive the same result when it completes.
+    """
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.jobs = {} # (url key, format) -> DownloadJob
+        self.deferred = set() # Jobs whose last waiter has left but whose files must stay a while longer
+
+    def join(self, url, format_option, key=None):
+        """
+        Returns the job for this URL and format, starting the download if none is in flight.
+        'key' identifies identical content (defaults to the URL itself).
+        Every call must be matched by a call to leave().
+        """
+        job_key = (key or url, format_option)
+        job = self.jobs.get(job_key)
+        if job is None:
+            task = asyncio.create_task(self.downloader.download_content(url, format_option))
+            job = DownloadJob(job_key, task)
+            self.jobs[job_key] = job
+        else:
+            logger.info(f"Attaching to in-flight download for {job_key[0]} ({job.waiters} waiter(s) already).")
+        job.waiters += 1
+        return job
+
+    def leave(self, job, cleanup_delay=0):
+        """
+        Drops one reference to the job. 'cleanup_delay' keeps the files for at least that
+        many more seconds (e.g. while a local Bot API server may still be reading them).
+        When the last reference is gone the job is forgotten, so new requests start a fresh
+        download, and its files are removed once the latest requested delay has passed.
+        """
+        if cleanup_delay:
+            job.release_at = max(job.release_at, time.monotonic() + cleanup_delay)
+        job.waiters -= 1
+        if job.waiters > 0:
+            return
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        remaining = job.release_at - time.monotonic()
+        if remaining > 0:
+            self.deferred.add(job)
+            asyncio.get_running_loop().call_later(remaining, self._release, job)
+        else:
+            self._release(job)
+
+    def _release(self, job):
+        if job.released:
+            return
+        job.released = True
+        self.deferred.discard(job)
+        if job.task.done():
+            self._cleanup_files(job)
+        else:
+            # Every waiter left before the download finished; clean up whenever it does
+            job.task.add_done_callback(lambda _task: self._cleanup_files(job))
+
+    def _cleanup_files(self, job):
+        # A newer job for the same content may have written to the same path; leave its files alone
+        in_use = {
+            path for other in list(self.jobs.values()) + list(self.deferred)
+            if other is not job for path in other.file_paths()
+        }
+        for path in job.file_paths():
+            if path not in in_use:
+                self.downloader.cleanup_file(path)
@@ -92,6 +92,9 @@ UPLOAD_FOLDER=${INSTALL_DIR}/downloads
 WEBHOOK_PORT=8443
 WEBHOOK_LISTEN_ADDRESS=0.0.0.0
 DOMAIN_NAME=${DOMAIN_NAME_PROMPT}
+# Optional: URL of a self-hosted telegram-bot-api server (--local) for uploads up to 2 GB, e.g. http://127.0.0.1:8081
+# The server must be able to read ${INSTALL_DIR}/downloads.
+LOCAL_BOT_API_URL=
 EOL
 echo ".env file created."
 
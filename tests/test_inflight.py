@@ -0,0 +1,162 @@
+import asyncio
+
+from inflight import DownloadJob, InFlightDownloads
+
+
+class StubDownloader:
+    """Stands in for downloader.Downloader: every download of a URL writes the same output path."""
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.downloads = []
+        self.cleaned = []
+
+    async def download_content(self, url, format_option):
+        self.downloads.append(url)
+        await asyncio.sleep(self.delay)
+        return {'status': 'completed', 'path': f"/downloads/{url}.mp4"}
+
+    def cleanup_file(self, path):
+        self.cleaned.append((path, asyncio.get_running_loop().time()))
+
+
+def test_concurrent_requests_share_one_download():
+    downloader = StubDownloader()
+    jobs = InFlightDownloads(downloader)
+
+    async def handler():
+        job = jobs.join('a', 'best')
+        try:
+            return await job.result()
+        finally:
+            jobs.leave(job)
+
+    async def main():
+        return await asyncio.gather(*[handler() for _ in range(5)])
+
+    results = asyncio.run(main())
+    assert downloader.downloads == ['a']
+    assert all(result['path'] == '/downloads/a.mp4' for result in results)
+    assert [path for path, _ in downloader.cleaned] == ['/downloads/a.mp4'] # Cleaned once, after the last waiter
+    assert jobs.jobs == {}
+
+
+def test_files_kept_until_last_waiter_leaves():
+    downloader = StubDownloader()
+    jobs = InFlightDownloads(downloader)
+
+    async def main():
+        first = jobs.join('a', 'best')
+        second = jobs.join('a', 'best')
+        assert first is second
+        await first.result()
+        jobs.leave(first)
+        assert downloader.cleaned == []
+        jobs.leave(second)
+        assert [path for path, _ in downloader.cleaned] == ['/downloads/a.mp4']
+
+    asyncio.run(main())
+
+
+def test_deferred_cleanup_is_honoured_by_every_waiter():
+    downloader = StubDownloader()
+    jobs = InFlightDownloads(downloader)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        timed_out = jobs.join('a', 'best')
+        other = jobs.join('a', 'best')
+        await timed_out.result()
+        start = loop.time()
+        jobs.leave(timed_out, cleanup_delay=0.2) # e.g. local Bot API server still reading
+        jobs.leave(other) # Must not remove the files before the deadline
+        assert downloader.cleaned == []
+
+        # A new request after the last waiter left starts a fresh job for the same output path
+        fresh = jobs.join('a', 'best')
+        assert fresh is not timed_out
+        await fresh.result()
+
+        await asyncio.sleep(0.3)
+        assert downloader.cleaned == [] # The fresh job still holds the file
+
+        jobs.leave(fresh)
+        assert len(downloader.cleaned) == 1
+        assert downloader.cleaned[0][1] - start >= 0.2
+
+    asyncio.run(main())
+
+
+def test_deferred_cleanup_runs_once():
+    downloader = StubDownloader()
+    jobs = InFlightDownloads(downloader)
+
+    async def main():
+        job = jobs.join('a', 'best')
+        await job.result()
+        jobs.leave(job, cleanup_delay=0.05)
+        await asyncio.sleep(0.1)
+        assert [path for path, _ in downloader.cleaned] == ['/downloads/a.mp4']
+        jobs._release(job) # A stale timer firing again must be a no-op
+        assert len(downloader.cleaned) == 1
+
+    asyncio.run(main())
+
+
+def test_missing_file_id_does_not_block_a_later_one():
+    job = DownloadJob(('a', 'best'), task=None)
+    job.remember_file_id('/downloads/a.mp4', None)
+    assert job.file_ids == {}
+    job.remember_file_id('/downloads/a.mp4', 'first-id')
+    job.remember_file_id('/downloads/a.mp4', 'second-id')
+    assert job.file_ids == {'/downloads/a.mp4': 'first-id'}
+
+
+def test_waiter_with_a_file_id_does_not_queue_behind_an_upload():
+    job = DownloadJob(('a', 'best'), task=None)
+    job.remember_file_id('/downloads/a.mp4', 'a-id')
+    upload_started = None
+    release_upload = None
+    sent_with = []
+
+    async def stalled_upload(file_ids):
+        upload_started.set()
+        await release_upload.wait() # e.g. a slow first upload of another file
+        return {'/downloads/b.mp4': 'b-id'}
+
+    async def resend(file_ids):
+        sent_with.append(file_ids['/downloads/a.mp4'])
+        return {}
+
+    async def main():
+        nonlocal upload_started, release_upload
+        upload_started, release_upload = asyncio.Event(), asyncio.Event()
+        uploader = asyncio.create_task(job.send_files(['/downloads/b.mp4'], stalled_upload))
+        await upload_started.wait()
+        assert job.send_lock.locked()
+        await asyncio.wait_for(job.send_files(['/downloads/a.mp4'], resend), timeout=0.5)
+        assert sent_with == ['a-id']
+        release_upload.set()
+        await uploader
+
+    asyncio.run(main())
+    assert job.file_ids['/downloads/b.mp4'] == 'b-id'
+
+
+def test_concurrent_first_sends_upload_once():
+    job = DownloadJob(('a', 'best'), task=None)
+    uploads = []
+
+    async def send(file_ids):
+        file_id = file_ids.get('/downloads/a.mp4')
+        if file_id is None:
+            uploads.append('/downloads/a.mp4')
+            await asyncio.sleep(0.01)
+            return {'/downloads/a.mp4': 'a-id'}
+        return {}
+
+    async def main():
+        await asyncio.gather(*[job.send_files(['/downloads/a.mp4'], send) for _ in range(5)])
+
+    asyncio.run(main())
+    assert uploads == ['/downloads/a.mp4']
+    assert job.file_ids == {'/downloads/a.mp4': 'a-id'}
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+from telegram import Bot, InputFile, InputMediaPhoto
+from telegram.error import NetworkError, TimedOut
+
+import uploads
+
+
+class StubBotAPIHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for a local telegram-bot-api server: records requests and answers like Telegram."""
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        self.requests.append((method, self.headers.get('Content-Type', ''), body))
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+        else:
+            result = {
+                'message_id': 1, 'date': 0, 'chat': {'id': 42, 'type': 'private'},
+                'document': {'file_id': 'stub-file-id', 'file_unique_id': 'stub-unique-id'},
+            }
+            if method == 'sendMediaGroup':
+                result = [result]
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    StubBotAPIHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloaded_file(tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(b'x' * 1024)
+    return path
+
+
+def test_local_mode_sends_file_uri(monkeypatch, stub_server, downloaded_file):
+    monkeypatch.setattr(uploads, 'USE_LOCAL_BOT_API', True)
+    source = uploads.build_upload_source(str(downloaded_file))
+    assert source == downloaded_file.resolve().as_uri()
+
+    async def send():
+        bot = Bot('123:abc', base_url=f"{stub_server}/bot", base_file_url=f"{stub_server}/file/bot", local_mode=True)
+        async with bot:
+            return await bot.send_document(chat_id=42, document=source)
+
+    message = asyncio.run(send())
+    assert message.document.file_id == 'stub-file-id'
+
+    method, content_type, body = StubBotAPIHandler.requests[-1]
+    assert method == 'sendDocument'
+    assert 'multipart' not in content_type # Nothing was uploaded through the bot
+    assert b'x' * 1024 not in body
+    assert parse_qs(body.decode())['document'] == [source]
+
+
+def test_public_mode_uploads_file_contents(monkeypatch, downloaded_file):
+    monkeypatch.setattr(uploads, 'USE_LOCAL_BOT_API', False)
+    source = uploads.build_upload_source(str(downloaded_file))
+    assert isinstance(source, InputFile)
+    assert source.input_file_content == downloaded_file.read_bytes()
+    assert source.filename == 'video.mp4'
+
+
+def test_cleanup_deferred_only_after_local_timeout(monkeypatch):
+    monkeypatch.setattr(uploads, 'USE_LOCAL_BOT_API', True)
+    assert uploads.cleanup_delay_after_failed_send(TimedOut()) == uploads.LOCAL_BOT_API_SEND_TIMEOUT
+    assert uploads.cleanup_delay_after_failed_send(NetworkError('boom')) == 0
+
+    monkeypatch.setattr(uploads, 'USE_LOCAL_BOT_API', False)
+    assert uploads.cleanup_delay_after_failed_send(TimedOut()) == 0
+
+
+
+def test_public_mode_media_group_items_are_attached(monkeypatch, stub_server, downloaded_file):
+    monkeypatch.setattr(uploads, 'USE_LOCAL_BOT_API', False)
+    media = InputMediaPhoto(uploads.build_upload_source(str(downloaded_file), attach=True))
+
+    async def send():
+        async with Bot('123:abc', base_url=f"{stub_server}/bot") as bot:
+            return await bot.send_media_group(chat_id=42, media=[media])
+
+    asyncio.run(send())
+    method, content_type, body = StubBotAPIHandler.requests[-1]
+    assert method == 'sendMediaGroup'
+    assert 'multipart' in content_type # The file contents are uploaded as a separate part
+    assert b'"media": "attach://' in body or b'"media":"attach://' in body
@@ -0,0 +1,141 @@
+import asyncio
+import io
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import url_router
+from url_router import TTLCache, is_short_link, route_url
+
+
+@pytest.mark.parametrize('url, platform, canonical', [
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abc&t=5', 'youtube', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+    ('https://youtu.be/dQw4w9WgXcQ?si=x', 'youtube', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+    ('https://m.youtube.com/shorts/dQw4w9WgXcQ', 'youtube', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+    ('https://www.tiktok.com/@some.user/video/7234567890123456789?is_from_webapp=1', 'tiktok', 'https://www.tiktok.com/@some.user/video/7234567890123456789'),
+    ('https://www.instagram.com/reels/Cabc_12-x/?igsh=zz', 'instagram', 'https://www.instagram.com/reel/Cabc_12-x/'),
+    ('https://twitter.com/jack/status/20?s=20', 'x', 'https://x.com/jack/status/20'),
+    ('https://x.com/i/web/status/20', 'x', 'https://x.com/i/status/20'),
+])
+def test_post_urls_are_canonicalised(url, platform, canonical):
+    route = route_url(url)
+    assert route['platform'] == platform
+    assert route['url'] == canonical
+    assert route['content_id'] is not None
+    assert route['extractor'] is not None
+    assert route['key'] == f"{platform}:{route['content_id']}"
+
+
+def test_same_content_shares_a_key():
+    assert route_url('https://youtu.be/dQw4w9WgXcQ')['key'] == route_url('https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share')['key']
+
+
+def test_lookalike_hosts_are_generic():
+    assert route_url('https://www.box.com/s/abc')['platform'] == 'generic'
+    assert route_url('https://notyoutube.com/watch?v=dQw4w9WgXcQ')['platform'] == 'generic'
+
+
+@pytest.mark.parametrize('url, platform', [
+    ('https://www.instagram.com/stories/someone/123/', 'instagram'),
+    ('https://www.tiktok.com/@u/photo/123', 'tiktok'),
+    ('https://www.youtube.com/playlist?list=PL123', 'youtube'),
+    ('https://www.youtube.com/@channel', 'youtube'),
+])
+def test_other_pages_on_platform_hosts_keep_their_platform(url, platform):
+    route = route_url(url)
+    assert route['platform'] == platform
+    assert route['extractor'] is None # Not the post extractor; yt-dlp must pick e.g. YoutubeTab itself
+    assert route['content_id'] is None
+    assert route['url'] == route['key'] == url
+
+
+def test_short_links_are_detected():
+    assert is_short_link('https://vm.tiktok.com/ZMabc/')
+    assert is_short_link('https://www.tiktok.com/t/ZT8abc/')
+    assert is_short_link('https://t.co/abc')
+    assert not is_short_link('https://x.com/jack/status/20')
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=100)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=2, ttl=-1) # Already expired when stored
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+@pytest.mark.parametrize('url, canonical', [
+    ('https://example.com/page#/route/a', 'https://example.com/page#/route/a'),
+    ('https://example.com/a?b&c=1', 'https://example.com/a?b&c=1'),
+    ('https://example.com/a?x=1&utm_source=feed&fbclid=abc&y=%20', 'https://example.com/a?x=1&y=%20'),
+    ('http://[::1]:8080/x', 'http://[::1]:8080/x'),
+    ('https://user:pw@WWW.Example.com:443/path', 'https://www.example.com/path'),
+    ('http://example.com:8080/path', 'http://example.com:8080/path'),
+])
+def test_generic_urls_keep_pointing_at_the_same_page(url, canonical):
+    route = route_url(url)
+    assert route['platform'] == 'generic'
+    assert route['url'] == route['key'] == canonical
+
+
+def test_concurrent_short_link_lookups_are_shared(monkeypatch):
+    lookups = []
+
+    def slow_follow_redirects(url):
+        lookups.append(url)
+        time.sleep(0.05)
+        return 'https://www.tiktok.com/@u/video/123?_r=1'
+
+    monkeypatch.setattr(url_router, '_follow_redirects', slow_follow_redirects)
+    monkeypatch.setattr(url_router, 'redirect_cache', TTLCache(maxsize=10, ttl=100))
+
+    async def main():
+        return await asyncio.gather(*[url_router.resolve_url('https://vm.tiktok.com/ZMabc/') for _ in range(10)])
+
+    routes = asyncio.run(main())
+    assert lookups == ['https://vm.tiktok.com/ZMabc/']
+    assert all(route['key'] == 'tiktok:123' for route in routes)
+    assert url_router.pending_resolutions == {}
+
+    # Later requests are answered from the cache
+    asyncio.run(url_router.resolve_url('https://vm.tiktok.com/ZMabc/'))
+    assert len(lookups) == 1
+
+
+def test_failed_short_link_lookup_routes_the_short_link(monkeypatch):
+    monkeypatch.setattr(url_router, '_follow_redirects', lambda url: None)
+    monkeypatch.setattr(url_router, 'redirect_cache', TTLCache(maxsize=10, ttl=100))
+    route = asyncio.run(url_router.resolve_url('https://t.co/abc'))
+    assert route['url'] == 'https://t.co/abc'
+    assert url_router.redirect_cache.get('https://t.co/abc') is None # Failures are not cached
+
+
+def test_http_error_after_redirects_keeps_the_final_url(monkeypatch):
+    requested = []
+
+    def blocked_urlopen(request, timeout):
+        requested.append(request.get_method())
+        # urllib raises this once the redirect chain ends on an anti-bot 403
+        raise urllib.error.HTTPError('https://www.tiktok.com/@u/video/123?_r=1', 403, 'Forbidden', {}, io.BytesIO(b''))
+
+    monkeypatch.setattr(urllib.request, 'urlopen', blocked_urlopen)
+    assert url_router._follow_redirects('https://vm.tiktok.com/ZMabc/') == 'https://www.tiktok.com/@u/video/123?_r=1'
+    assert requested == ['HEAD']
+
+
+def test_http_error_without_redirect_is_a_failed_lookup(monkeypatch):
+    def not_found(request, timeout):
+        raise urllib.error.HTTPError(request.full_url, 404, 'Not Found', {}, io.BytesIO(b''))
+
+    monkeypatch.setattr(urllib.request, 'urlopen', not_found)
+    assert url_router._follow_redirects('https://vm.tiktok.com/ZMabc/') is None
@@ -0,0 +1,45 @@
+import os
+from pathlib import Path # For building file:// URIs for the local Bot API server
+from dotenv import load_dotenv
+from telegram import InputFile
+from telegram.error import TimedOut
+
+# Load environment variables (usually for local development or when called directly)
+load_dotenv()
+
+# Base URL of a self-hosted telegram-bot-api server started with --local (e.g. http://127.0.0.1:8081).
+# When set, files in DOWNLOADS_DIR are sent by file:// path and the server reads them from disk itself,
+# so nothing is streamed through this process. Leave empty to use the public Bot API.
+LOCAL_BOT_API_URL = os.getenv('LOCAL_BOT_API_URL', '').strip().rstrip('/')
+USE_LOCAL_BOT_API = bool(LOCAL_BOT_API_URL)
+# The local server may take a while to push a large file to Telegram before it answers our request
+LOCAL_BOT_API_SEND_TIMEOUT = float(os.getenv('LOCAL_BOT_API_SEND_TIMEOUT', 600))
+
+
+def build_upload_source(file_path, attach=False):
+    """
+    Returns the value to pass to Telegram's send_* methods for a downloaded file.
+    With a local Bot API server this is a file:// URI that the server reads straight from disk,
+    otherwise the file is read into an InputFile and uploaded through this process.
+    Pass attach=True for media wrapped in InputMedia* (media groups), which Telegram only
+    accepts as an attach:// reference to the uploaded part.
+    """
+    if USE_LOCAL_BOT_API:
+        return Path(file_path).resolve().as_uri()
+    with open(file_path, 'rb') as f:
+        return InputFile(f, filename=os.path.basename(file_path), attach=attach)
+
+
+# Extra keyword arguments for send_* calls that transfer files.
+# The local server only answers once it has finished reading and uploading the file, which can be slow.
+SEND_FILE_KWARGS = {'read_timeout': LOCAL_BOT_API_SEND_TIMEOUT} if USE_LOCAL_BOT_API else {}
+
+
+def cleanup_delay_after_failed_send(error):
+    """
+    Returns how many seconds to keep downloaded files after a failed send.
+    If a local Bot API server timed out it may still be reading the file, so removal is deferred.
+    """
+    if USE_LOCAL_BOT_API and isinstance(error, TimedOut):
+        return LOCAL_BOT_API_SEND_TIMEOUT
+    return 0
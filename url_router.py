@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, unquote_plus
+from dotenv import load_dotenv
+
+# Load environment variables (usually for local development or when called directly)
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Short-link resolution settings
+SHORT_LINK_CACHE_SIZE = int(os.getenv('SHORT_LINK_CACHE_SIZE', 1024)) # Max number of resolved short links kept in memory
+SHORT_LINK_CACHE_TTL = int(os.getenv('SHORT_LINK_CACHE_TTL', 6 * 60 * 60)) # Seconds a resolved short link stays valid
+SHORT_LINK_RESOLVE_TIMEOUT = 10 # Seconds to wait for a short-link redirect
+RESOLVE_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+# Query parameters that only track where a link was shared from and never change the content.
+# Platform URLs are rebuilt from their content id anyway; this list is for generic links,
+# so it only contains names that are never meaningful to a site.
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'twclid', 'ttclid', 'mc_cid', 'mc_eid', 'igshid', 'igsh',
+}
+TRACKING_PARAM_PREFIXES = ('utm_',)
+
+# --- Platform Routes ---
+# Each route lists the exact hosts it accepts and the path patterns that identify a single post.
+# 'extractor' is the yt-dlp extractor key for that content (usable as ie_key in YoutubeDL.extract_info),
+# so the downloader does not have to probe every extractor or fall back to the generic one.
+# 'id_param' names the query parameter holding the content id when the path does not contain it,
+# 'id_pattern' validates that id.
+PLATFORM_ROUTES = [
+    {
+        'platform': 'tiktok',
+        'extractor': 'TikTok',
+        'hosts': re.compile(r'(?:www\.|m\.)?tiktok\.com'),
+        'paths': [re.compile(r'/@(?P<user>[\w.-]*)/video/(?P<id>\d+)/?'), re.compile(r'/embed(?:/v2)?/(?P<id>\d+)/?')],
+        'canonical': 'https://www.tiktok.com/@{user}/video/{id}',
+        'defaults': {'user': ''},
+    },
+    {
+        'platform': 'instagram',
+        'extractor': 'Instagram',
+        'hosts': re.compile(r'(?:www\.|m\.)?instagram\.com'),
+        'paths': [re.compile(r'/(?:[\w.]+/)?(?P<kind>p|reel|tv)s?/(?P<id>[\w-]+)/?')],
+        'canonical': 'https://www.instagram.com/{kind}/{id}/',
+        'defaults': {},
+    },
+    {
+        'platform': 'youtube',
+        'extractor': 'Youtube',
+        'hosts': re.compile(r'(?:www\.|m\.|music\.)?youtube(?:-nocookie)?\.com'),
+        'paths': [re.compile(r'/(?:shorts|embed|live|v)/(?P<id>[\w-]{11})/?')],
+        'canonical': 'https://www.youtube.com/watch?v={id}',
+        'defaults': {},
+    },
+    {
+        'platform': 'youtube',
+        'extractor': 'Youtube',
+        'hosts': re.compile(r'(?:www\.|m\.|music\.)?youtube(?:-nocookie)?\.com'),
+        'paths': [re.compile(r'/watch/?')],
+        'id_param': 'v',
+        'id_pattern': re.compile(r'[\w-]{11}'),
+        'canonical': 'https://www.youtube.com/watch?v={id}',
+        'defaults': {},
+    },
+    {
+        'platform': 'youtube',
+        'extractor': 'Youtube',
+        'hosts': re.compile(r'youtu\.be'),
+        'paths': [re.compile(r'/(?P<id>[\w-]{11})/?')],
+        'canonical': 'https://www.youtube.com/watch?v={id}',
+        'defaults': {},
+    },
+    {
+        'platform': 'x',
+        'extractor': 'Twitter',
+        'hosts': re.compile(r'(?:www\.|mobile\.)?(?:x|twitter)\.com'),
+        'paths': [re.compile(r'/(?:i/web|(?P<user>\w+))/status(?:es)?/(?P<id>\d+)(?:/(?:photo|video)/\d+)?/?')],
+        'canonical': 'https://x.com/{user}/status/{id}',
+        'defaults': {'user': 'i'},
+    },
+]
+
+# Hosts that only redirect to the real post and must be resolved over the network first
+SHORT_LINK_HOSTS = re.compile(r'(?:vm|vt)\.tiktok\.com|t\.co|instagr\.am')
+# Short-link paths on otherwise normal hosts (e.g. https://www.tiktok.com/t/ZT8abc/)
+SHORT_LINK_PATHS = [(re.compile(r'(?:www\.|m\.)?tiktok\.com'), re.compile(r'/t/[\w-]+/?'))]
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after 'ttl' seconds."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires_at, value), oldest first
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key) # Mark as recently used
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False) # Drop the least recently used entry
+
+
+# Resolved short links (short URL -> final URL), shared by every request
+redirect_cache = TTLCache(SHORT_LINK_CACHE_SIZE, SHORT_LINK_CACHE_TTL)
+# Short links being resolved right now (short URL -> asyncio.Task), so a burst of
+# requests for the same link shares a single network lookup
+pending_resolutions = {}
+
+
+def _strip_tracking_params(query):
+    """Removes tracking parameters from a query string, leaving every other pair exactly as written."""
+    kept = []
+    for pair in query.split('&'):
+        name = unquote_plus(pair.split('=', 1)[0]).lower()
+        if name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES):
+            continue
+        kept.append(pair)
+    return '&'.join(kept)
+
+
+def _normalize_netloc(parts):
+    """Returns the lower-cased netloc without credentials or a default port (IPv6 brackets are kept)."""
+    netloc = parts.netloc.rpartition('@')[2].lower()
+    default_port = {'http': ':80', 'https': ':443'}.get(parts.scheme.lower())
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return netloc
+
+
+def is_short_link(url):
+    """Returns True if the URL only redirects to the real content and needs resolving."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').rstrip('.')
+    if SHORT_LINK_HOSTS.fullmatch(host):
+        return True
+    return any(host_re.fullmatch(host) and path_re.fullmatch(parts.path) for host_re, path_re in SHORT_LINK_PATHS)
+
+
+def route_url(url):
+    """
+    Matches a URL against the platform routes without any network access.
+    Returns a dict with:
+      'platform'   - 'tiktok', 'instagram', 'youtube', 'x' (by host) or 'generic'
+      'extractor'  - yt-dlp extractor key for recognised posts, or None to let yt-dlp detect it
+                     (generic links and other pages such as playlists, channels or stories)
+      'url'        - canonical URL (tracking parameters removed, host normalised)
+      'content_id' - post/video id on the platform, or None if the URL is not a recognised post
+      'key'        - stable identifier of the content, suitable for caching and deduplication
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.') # Lower-cased, without port or credentials
+
+    host_route = None # First route whose host matched, used if none of the post patterns do
+    for route in PLATFORM_ROUTES:
+        if not route['hosts'].fullmatch(host):
+            continue
+        host_route = host_route or route
+        for path_re in route['paths']:
+            match = path_re.fullmatch(parts.path)
+            if not match:
+                continue
+            fields = dict(route['defaults'])
+            fields.update({name: value for name, value in match.groupdict().items() if value})
+            if 'id_param' in route:
+                fields['id'] = dict(parse_qsl(parts.query)).get(route['id_param'], '')
+                if not route['id_pattern'].fullmatch(fields['id']):
+                    continue
+            return {
+                'platform': route['platform'],
+                'extractor': route['extractor'],
+                'url': route['canonical'].format(**fields),
+                'content_id': fields['id'],
+                'key': f"{route['platform']}:{fields['id']}",
+            }
+
+    # Not a known post URL: keep it as is apart from obvious noise, so it still points at the same page
+    canonical = urlunsplit((scheme, _normalize_netloc(parts), parts.path or '/', _strip_tracking_params(parts.query), parts.fragment))
+    if host_route:
+        # Other pages on a platform's host (stories, playlists, channels, ...) still belong to that platform,
+        # but are handled by other yt-dlp extractors (e.g. YoutubeTab, InstagramStory), so leave detection to yt-dlp
+        return {'platform': host_route['platform'], 'extractor': None, 'url': canonical, 'content_id': None, 'key': canonical}
+    return {'platform': 'generic', 'extractor': None, 'url': canonical, 'content_id': None, 'key': canonical}
+
+
+def _follow_redirects(url):
+    """Blocking helper: returns the final URL after following all redirects."""
+    for method in ('HEAD', 'GET'): # Some sites reject HEAD, so fall back to GET (body is not read)
+        request = urllib.request.Request(url, method=method, headers={'User-Agent': RESOLVE_USER_AGENT})
+        try:
+            with urllib.request.urlopen(request, timeout=SHORT_LINK_RESOLVE_TIMEOUT) as response:
+                return response.geturl()
+        except urllib.error.HTTPError as e:
+            # Raised after the redirects were followed, e.g. an anti-bot 403 on the final page:
+            # its URL is still the post the short link points at
+            if e.geturl() and e.geturl() != url:
+                return e.geturl()
+            logger.warning(f"{method} request failed while resolving short link {url}: {e}")
+        except Exception as e:
+            logger.warning(f"{method} request failed while resolving short link {url}: {e}")
+    return None
+
+
+async def _resolve_and_cache(url):
+    """Resolves one short link in a worker thread and caches the result."""
+    try:
+        # Run the blocking HTTP request in a separate thread to not block the event loop
+        resolved = await asyncio.to_thread(_follow_redirects, url)
+        if resolved:
+            redirect_cache.set(url, resolved)
+        return resolved
+    finally:
+        pending_resolutions.pop(url, None)
+
+
+async def resolve_url(url):
+    """
+    Like route_url(), but first expands short links (vm.tiktok.com, t.co, ...) to the post
+    they point at. Resolved links are cached and concurrent lookups of the same link are
+    shared, so a viral short link is only resolved once.
+    If resolution fails the short link itself is routed (usually as 'generic').
+    """
+    url = url.strip()
+    if not is_short_link(url):
+        return route_url(url)
+
+    resolved = redirect_cache.get(url)
+    if resolved is None:
+        task = pending_resolutions.get(url)
+        if task is None:
+            task = asyncio.create_task(_resolve_and_cache(url))
+            pending_resolutions[url] = task
+        # shield() keeps the lookup running for the other requests if this one is cancelled
+        resolved = await asyncio.shield(task) or url
+    return route_url(resolved)